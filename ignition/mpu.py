@@ -1,4 +1,8 @@
-from machine import Pin, I2C, UART
+try:
+    from machine import Pin, I2C, UART
+except ImportError:
+    # Running on a host (e.g. reprocess.py) - only the classifier/tracker logic is used
+    Pin = I2C = UART = None
 import time
 import math
 
@@ -0,0 +1,332 @@
+"""
+Batch reprocessing of archived rides (runs on a PC, not on the Pico-W)
+
+Replays exported rides through the same ActivityClassifier / RideTracker
+logic used on the device, so activity and distance can be re-derived after
+the thresholds change.
+
+Supported archive files:
+  *.gpx          - tracks written by RideTracker.export_path_gpx()
+  *.jsonl, *.log - one RideTracker point dict (JSON) per line
+
+Usage:
+  python reprocess.py <archive_dir> <results.jsonl> [--workers N]
+  python reprocess.py <archive_dir> <results.jsonl> --scale 1,2,4,8
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from mpu import RideTracker
+
+RIDE_EXTENSIONS = ('.gpx', '.jsonl', '.log')
+
+# Used when an archive has no IMU data (GPX exports): sensor at rest, 1g on Z
+REST_ACCEL = {'x': 0.0, 'y': 0.0, 'z': 1.0}
+REST_GYRO = {'x': 0.0, 'y': 0.0, 'z': 0.0}
+
+
+class ReplayGPS:
+    """Stands in for NEOM8N_GPS, fed from archived points"""
+
+    def __init__(self):
+        self.latitude = None
+        self.longitude = None
+        self.altitude = None
+        self.timestamp = None
+        self.date = None
+        self.satellites = 0
+        self.fix_quality = 0
+        self.speed = 0.0
+
+    def load(self, point):
+        """Set current state from an archived point"""
+        self.latitude = point['lat']
+        self.longitude = point['lon']
+        self.altitude = point.get('alt')
+        self.timestamp = point.get('time')
+        self.date = point.get('date')
+        self.speed = point.get('speed') or 0.0
+        has_position = self.latitude is not None and self.longitude is not None
+        self.fix_quality = 1 if has_position else 0
+        self.satellites = 4 if has_position else 0
+
+    def has_fix(self):
+        """Check if GPS has valid fix"""
+        return self.fix_quality > 0 and self.satellites >= 3
+
+
+class ReplayMPU:
+    """Stands in for MPU6050, fed from archived points"""
+
+    def __init__(self):
+        self.accel = REST_ACCEL
+        self.gyro = REST_GYRO
+
+    def load(self, point):
+        """Set current state from an archived point"""
+        if 'accel_x' in point:
+            self.accel = {'x': point['accel_x'], 'y': point['accel_y'], 'z': point['accel_z']}
+        else:
+            self.accel = REST_ACCEL
+        if 'gyro_x' in point:
+            self.gyro = {'x': point['gyro_x'], 'y': point['gyro_y'], 'z': point['gyro_z']}
+        else:
+            self.gyro = REST_GYRO
+
+    def get_accel_data(self):
+        """Get accelerometer data in g"""
+        return self.accel
+
+    def get_gyro_data(self):
+        """Get gyroscope data in degrees/second"""
+        return self.gyro
+
+
+def _to_float(text):
+    """Parse a number written by the exporter ('None' for missing values)"""
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def iter_gpx_points(path):
+    """Stream track points from a GPX file without loading the whole tree"""
+    for _, elem in ET.iterparse(path, events=('end',)):
+        # Strip any namespace, e.g. {http://www.topografix.com/GPX/1/1}trkpt
+        if elem.tag.rsplit('}', 1)[-1] != 'trkpt':
+            continue
+
+        point = {
+            'lat': _to_float(elem.get('lat')),
+            'lon': _to_float(elem.get('lon')),
+        }
+        for child in elem.iter():
+            tag = child.tag.rsplit('}', 1)[-1]
+            if tag == 'ele':
+                point['alt'] = _to_float(child.text)
+            elif tag == 'time' and child.text:
+                date, _, clock = child.text.rstrip('Z').partition('T')
+                point['date'] = date
+                point['time'] = clock
+            elif tag == 'speed':
+                point['speed'] = _to_float(child.text)
+
+        elem.clear()
+        yield point
+
+
+def iter_log_points(path):
+    """Stream point dicts from a JSON-lines log, skipping broken lines"""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                point = json.loads(line)
+            except ValueError:
+                continue
+            if 'lat' in point and 'lon' in point:
+                yield point
+
+
+def iter_ride_points(path):
+    """Stream points from any supported archive file"""
+    if path.lower().endswith('.gpx'):
+        return iter_gpx_points(path)
+    return iter_log_points(path)
+
+
+def iter_ride_files(archive_dir, exclude=()):
+    """
+    Walk the archive lazily, yielding ride file paths in a stable order.
+    exclude: paths to skip, e.g. a results file written inside the archive
+    """
+    exclude = {os.path.abspath(p) for p in exclude}
+    for root, dirs, files in os.walk(archive_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.lower().endswith(RIDE_EXTENSIONS) and os.path.abspath(path) not in exclude:
+                yield path
+
+
+def ride_key(path, archive_dir):
+    """Archive-relative ride path, the same however archive_dir is spelled"""
+    return os.path.relpath(path, archive_dir).replace(os.sep, '/')
+
+
+def replay_ride(path):
+    """Replay one archived ride through RideTracker and return its result record"""
+    gps = ReplayGPS()
+    mpu = ReplayMPU()
+    tracker = RideTracker(gps, mpu)
+
+    for point in iter_ride_points(path):
+        gps.load(point)
+        mpu.load(point)
+        tracker.update_classifier()
+        tracker.record_point()
+
+    stats = tracker.get_stats()
+    result = {'ride': path, 'points': len(tracker.path_points)}
+    if stats:
+        result.update({
+            'distance_km': stats['distance_km'],
+            'max_speed': stats['max_speed'],
+            'avg_speed': stats['avg_speed'],
+            'activity_breakdown': stats['activity_breakdown'],
+        })
+    return result
+
+
+def replay_ride_or_error(path):
+    """
+    Worker entry point: replay a ride, turning a failure of that ride
+    (e.g. a truncated GPX) into an error record. Pool failures are raised
+    in the parent instead, so the affected rides stay pending for resume.
+    """
+    try:
+        return replay_ride(path)
+    except Exception as e:
+        return {'ride': path, 'error': f"{type(e).__name__}: {e}"}
+
+
+def load_completed(results_file):
+    """Read rides already present in the results file (for resuming)"""
+    done = set()
+    if not os.path.exists(results_file):
+        return done
+    with open(results_file) as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)['ride'])
+            except (ValueError, KeyError, TypeError):
+                # Partially written last line from an interrupted run
+                continue
+    return done
+
+
+def reprocess(archive_dir, results_file=None, workers=None, resume=True):
+    """
+    Replay every ride in archive_dir across a process pool.
+    Results are appended to results_file (if given) as each ride finishes,
+    so an interrupted run can resume where it stopped. Rides that fail to
+    replay (e.g. a truncated GPX) get an 'error' record instead of
+    stopping the run, and are not retried on resume. A broken worker pool
+    raises BrokenProcessPool; the rides in flight are not recorded, so a
+    re-run retries them.
+    Returns (rides, points, seconds).
+    """
+    workers = workers or os.cpu_count() or 1
+    done = load_completed(results_file) if (results_file and resume) else set()
+    exclude = [results_file] if results_file else []
+    pending_files = ((p, ride_key(p, archive_dir)) for p in iter_ride_files(archive_dir, exclude)
+                     if ride_key(p, archive_dir) not in done)
+
+    out = None
+    if results_file:
+        out = open(results_file, 'a')
+        # Drop a half-written line left by an interrupted run
+        if out.tell() > 0:
+            with open(results_file, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    out.write('\n')
+
+    rides = 0
+    points = 0
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Keep a bounded number of rides in flight instead of queuing the whole archive
+            max_in_flight = workers * 4
+            in_flight = {}
+            exhausted = False
+
+            while in_flight or not exhausted:
+                while not exhausted and len(in_flight) < max_in_flight:
+                    pending = next(pending_files, None)
+                    if pending is None:
+                        exhausted = True
+                    else:
+                        path, key = pending
+                        in_flight[pool.submit(replay_ride_or_error, path)] = key
+
+                if not in_flight:
+                    break
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key = in_flight.pop(future)
+                    result = future.result()
+                    result['ride'] = key
+                    if 'error' in result:
+                        print(f"Skipping {key}: {result['error']}")
+                    else:
+                        rides += 1
+                        points += result['points']
+                    if out:
+                        out.write(json.dumps(result) + '\n')
+                        out.flush()
+    finally:
+        if out:
+            out.close()
+
+    return rides, points, time.perf_counter() - start
+
+
+def print_throughput(workers, rides, points, seconds):
+    """Print one throughput line"""
+    seconds = max(seconds, 1e-9)
+    print(f"Workers: {workers:>3} | Rides: {rides:>6} | Points: {points:>9} | "
+          f"Time: {seconds:7.2f}s | {rides / seconds:8.1f} rides/s | {points / seconds:10.1f} points/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-derive activity and distance for archived rides")
+    parser.add_argument('archive', help="Directory of exported .gpx / .jsonl rides")
+    parser.add_argument('results', nargs='?', help="Results file (JSON lines), appended to")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--restart', action='store_true', help="Ignore existing results instead of resuming")
+    parser.add_argument('--scale', help="Comma separated worker counts to benchmark, e.g. 1,2,4,8")
+    args = parser.parse_args()
+
+    if args.scale:
+        # Throughput only - results are not written
+        print("=" * 60)
+        print("Reprocessing throughput vs worker count")
+        print("=" * 60)
+        for workers in [int(w) for w in args.scale.split(',')]:
+            rides, points, seconds = reprocess(args.archive, workers=workers)
+            print_throughput(workers, rides, points, seconds)
+        return
+
+    if not args.results:
+        parser.error("results file is required unless --scale is used")
+
+    if args.restart and os.path.exists(args.results):
+        os.remove(args.results)
+
+    workers = args.workers or os.cpu_count() or 1
+    print(f"Reprocessing {args.archive} -> {args.results}")
+    rides, points, seconds = reprocess(args.archive, args.results, workers=workers)
+    print_throughput(workers, rides, points, seconds)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nInterrupted - run again to resume")
+        sys.exit(1)
+    except BrokenProcessPool as e:
+        print(f"\nWorker pool failed ({e}) - run again to resume")
+        sys.exit(1)
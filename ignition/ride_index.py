@@ -0,0 +1,531 @@
+"""
+Spatial index over archived rides (runs on a PC, not on the Pico-W)
+
+Answers "which rides passed through this area" and "all efforts on this
+road segment" without scanning every stored point.
+
+Each ride is split into chunks of consecutive points; every chunk's
+bounding box is registered in the grid cells it overlaps. A query only
+looks at the chunks in the cells it touches, then checks their points.
+Chunks are broken at large jumps (GPS glitches), and the rare chunk whose
+box still covers too many cells goes in an "oversize" list that every
+query checks, so no box ever costs more than MAX_CELLS_PER_BOX cells.
+
+The index is persisted as two append-only files, so rides can be added
+one at a time as they are ingested:
+  <index.jsonl>        - per ride: name, chunk boxes, offset into the points file
+  <index.jsonl>.points - per ride: the points, one JSON list per line
+Loading only reads the chunk boxes and rebuilds the grid (still linear in
+the number of chunks); a ride's points are read from disk the first time a
+query needs them.
+
+Usage:
+  python ride_index.py ingest <index.jsonl> <archive_dir>
+  python ride_index.py bbox   <index.jsonl> <min_lat> <min_lon> <max_lat> <max_lon>
+  python ride_index.py radius <index.jsonl> <lat> <lon> <radius_m>
+  python ride_index.py segment <index.jsonl> <lat1> <lon1> <lat2> <lon2> [--tolerance 25]
+  python ride_index.py bench [--rides 10000,100000]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from reprocess import iter_ride_files, iter_ride_points
+
+CELL_DEG = 0.01      # Grid cell size in degrees (~1.1 km of latitude)
+CHUNK_POINTS = 32    # Points per indexed chunk
+MAX_JUMP_DEG = 0.05  # Larger steps between points (~5 km) start a new chunk
+MAX_CELLS_PER_BOX = 256
+METERS_PER_DEG = 111320.0
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Distance between two GPS points in meters (same formula as RideTracker)"""
+    R = 6371000
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    delta_phi = math.radians(lat2 - lat1)
+    delta_lambda = math.radians(lon2 - lon1)
+    a = math.sin(delta_phi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda/2)**2
+    return 2 * R * math.atan2(math.sqrt(a), math.sqrt(1-a))
+
+
+def radius_bbox(lat, lon, radius_m):
+    """Bounding box (min_lat, min_lon, max_lat, max_lon) enclosing a circle"""
+    dlat = radius_m / METERS_PER_DEG
+    dlon = radius_m / (METERS_PER_DEG * max(math.cos(math.radians(lat)), 1e-6))
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+def _open_append(path, mode='a'):
+    """Open a line-based file for appending, starting a fresh line after a half-written one"""
+    f = open(path, mode)
+    if f.tell() > 0:
+        with open(path, 'rb') as check:
+            check.seek(-1, os.SEEK_END)
+            if check.read(1) != b'\n':
+                f.write(b'\n' if 'b' in mode else '\n')
+    return f
+
+
+def cumulative_distances(points):
+    """Distance in meters ridden up to each point, so any stretch's length is one subtraction"""
+    distances = [0.0]
+    for a, b in zip(points, points[1:]):
+        distances.append(distances[-1] + haversine(a[0], a[1], b[0], b[1]))
+    return distances
+
+
+def match_efforts(start_hits, end_hits, valid=None):
+    """
+    Pair point indices near the segment start with the next ones near its end.
+    Uses the last start hit before each end, so lingering at the start
+    does not count towards the effort. valid(start_index, end_index) can
+    reject a pair, e.g. one that wanders off the segment in between; it
+    must stay False for later ends once False, so the start is dropped
+    as soon as it is rejected.
+    Returns [(start_index, end_index), ...]
+    """
+    events = [(i, 0) for i in start_hits] + [(i, 1) for i in end_hits]
+    events.sort()
+    efforts = []
+    last_start = None
+    for index, kind in events:
+        if kind == 0:
+            last_start = index
+        elif last_start is not None and index > last_start:
+            if valid is None or valid(last_start, index):
+                efforts.append((last_start, index))
+            last_start = None
+    return efforts
+
+
+class RideIndex:
+    """Grid index over per-ride chunk bounding boxes"""
+
+    def __init__(self, path=None):
+        """
+        path: JSON-lines file the index is persisted to (points go in path + '.points').
+              None keeps the index in memory only.
+        """
+        self.path = path
+        self.points_path = path + '.points' if path else None
+        self.points_file = None
+        self.append_files = None
+        self.names = []
+        self.ride_ids = {}
+        self.points = []        # ride_id -> [(lat, lon), ...], None until read from disk
+        self.offsets = []       # ride_id -> byte offset in the points file
+        self.distances = {}     # ride_id -> cumulative_distances(), for segment queries
+        self.chunk_boxes = []   # ride_id -> [(min_lat, min_lon, max_lat, max_lon, start, end), ...]
+        self.grid = {}          # (cell_lat, cell_lon) -> [(ride_id, chunk), ...]
+        self.oversize = []      # [(ride_id, chunk), ...] too large for the grid
+
+        if path and os.path.exists(path):
+            self._load()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ride_ids
+
+    def _load(self):
+        """Rebuild the grid from the persisted chunk boxes (points stay on disk)"""
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    name = record['ride']
+                    boxes = [tuple(box) for box in record['chunks']]
+                    offset = record['offset']
+                except (ValueError, KeyError, TypeError):
+                    # Partially written line from an interrupted ingest
+                    continue
+                self._insert(name, boxes, None, offset)
+
+    def ride_points(self, ride_id):
+        """Get a ride's points, reading them from disk on first use"""
+        if self.points[ride_id] is None:
+            if self.points_file is None:
+                self.points_file = open(self.points_path, 'rb')
+            self.points_file.seek(self.offsets[ride_id])
+            self.points[ride_id] = [tuple(p) for p in json.loads(self.points_file.readline())]
+        return self.points[ride_id]
+
+    def ride_distances(self, ride_id):
+        """Get a ride's cumulative distances, computed on first use"""
+        if ride_id not in self.distances:
+            self.distances[ride_id] = cumulative_distances(self.ride_points(ride_id))
+        return self.distances[ride_id]
+
+    @staticmethod
+    def _cell_range(min_lat, min_lon, max_lat, max_lon):
+        """Get (lat_first, lat_last, lon_first, lon_last) cell numbers of a bounding box"""
+        return (math.floor(min_lat / CELL_DEG), math.floor(max_lat / CELL_DEG),
+                math.floor(min_lon / CELL_DEG), math.floor(max_lon / CELL_DEG))
+
+    def _query_cells(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        Get the occupied grid cells overlapping a bounding box.
+        Walks the box's cells when it is small, or the occupied cells when
+        the box covers more cells than the grid holds (e.g. the whole world).
+        """
+        lat0, lat1, lon0, lon1 = self._cell_range(min_lat, min_lon, max_lat, max_lon)
+        if (lat1 - lat0 + 1) * (lon1 - lon0 + 1) > len(self.grid):
+            return [cell for cell in self.grid
+                    if lat0 <= cell[0] <= lat1 and lon0 <= cell[1] <= lon1]
+        return [(cell_lat, cell_lon)
+                for cell_lat in range(lat0, lat1 + 1)
+                for cell_lon in range(lon0, lon1 + 1)
+                if (cell_lat, cell_lon) in self.grid]
+
+    @staticmethod
+    def _chunk_ranges(points):
+        """
+        Split a ride into [start, end) index ranges of up to CHUNK_POINTS segments.
+        Neighbouring chunks share their boundary point so no segment is lost,
+        except across a jump larger than MAX_JUMP_DEG, which is left out.
+        """
+        ranges = []
+        start = 0
+        for i in range(1, len(points)):
+            if abs(points[i][0] - points[i - 1][0]) > MAX_JUMP_DEG or \
+                    abs(points[i][1] - points[i - 1][1]) > MAX_JUMP_DEG:
+                ranges.append((start, i))
+                start = i
+            elif i - start == CHUNK_POINTS:
+                ranges.append((start, i + 1))
+                start = i
+        if not ranges or ranges[-1][1] < len(points):
+            ranges.append((start, len(points)))
+        return ranges
+
+    @classmethod
+    def _chunk_boxes(cls, points):
+        """Get (min_lat, min_lon, max_lat, max_lon, start, end) for each chunk of a ride"""
+        boxes = []
+        for start, end in cls._chunk_ranges(points):
+            lats = [p[0] for p in points[start:end]]
+            lons = [p[1] for p in points[start:end]]
+            boxes.append((min(lats), min(lons), max(lats), max(lons), start, end))
+        return boxes
+
+    def _insert(self, name, boxes, points, offset):
+        ride_id = len(self.names)
+        self.names.append(name)
+        self.ride_ids[name] = ride_id
+        self.points.append(points)
+        self.offsets.append(offset)
+
+        for chunk, box in enumerate(boxes):
+            lat0, lat1, lon0, lon1 = self._cell_range(*box[:4])
+            if (lat1 - lat0 + 1) * (lon1 - lon0 + 1) > MAX_CELLS_PER_BOX:
+                self.oversize.append((ride_id, chunk))
+                continue
+            for cell_lat in range(lat0, lat1 + 1):
+                for cell_lon in range(lon0, lon1 + 1):
+                    self.grid.setdefault((cell_lat, cell_lon), []).append((ride_id, chunk))
+        self.chunk_boxes.append(boxes)
+
+    def close(self):
+        """Close any files opened by queries or add_ride"""
+        if self.points_file:
+            self.points_file.close()
+            self.points_file = None
+        if self.append_files:
+            for f in self.append_files:
+                f.close()
+            self.append_files = None
+
+    def add_ride(self, name, points):
+        """
+        Add a ride and persist it.
+        points: [(lat, lon), ...]
+        Returns False if the ride is already indexed or has no points.
+        """
+        if name in self.ride_ids or not points:
+            return False
+
+        points = [(round(p[0], 6), round(p[1], 6)) for p in points]
+        boxes = self._chunk_boxes(points)
+        offset = None
+
+        if self.path:
+            if self.append_files is None:
+                self.append_files = (_open_append(self.points_path, 'ab'), _open_append(self.path))
+            points_out, index_out = self.append_files
+
+            # Points first: a ride only counts once its index line is written
+            offset = points_out.tell()
+            points_out.write(json.dumps(points, separators=(',', ':')).encode() + b'\n')
+            points_out.flush()
+            record = {'ride': name, 'chunks': boxes, 'offset': offset}
+            index_out.write(json.dumps(record, separators=(',', ':')) + '\n')
+            index_out.flush()
+
+        self._insert(name, boxes, points, offset)
+        return True
+
+    def ingest(self, archive_dir):
+        """
+        Add every not-yet-indexed ride from an archive. Returns the number added.
+        Files that cannot be read are reported and skipped.
+        """
+        added = 0
+        for path in iter_ride_files(archive_dir):
+            name = os.path.splitext(os.path.relpath(path, archive_dir))[0].replace(os.sep, '/')
+            if name in self.ride_ids:
+                continue
+            try:
+                points = [(p['lat'], p['lon']) for p in iter_ride_points(path)
+                          if p['lat'] is not None and p['lon'] is not None]
+            except Exception as e:
+                # e.g. a truncated GPX; it is tried again on the next ingest
+                print(f"Skipping {name}: {type(e).__name__}: {e}")
+                continue
+            if self.add_ride(name, points):
+                added += 1
+        return added
+
+    def _candidate_chunks(self, min_lat, min_lon, max_lat, max_lon):
+        """Get {ride_id: set(chunk)} whose boxes intersect a bounding box"""
+        candidates = {}
+        entries = [self.grid[cell] for cell in self._query_cells(min_lat, min_lon, max_lat, max_lon)]
+        entries.append(self.oversize)
+        for entry in entries:
+            for ride_id, chunk in entry:
+                box = self.chunk_boxes[ride_id][chunk]
+                if box[0] <= max_lat and box[2] >= min_lat and box[1] <= max_lon and box[3] >= min_lon:
+                    candidates.setdefault(ride_id, set()).add(chunk)
+        return candidates
+
+    def _chunk_indices(self, ride_id, chunks):
+        """Yield point indices covered by a ride's chunks, in order and without repeats"""
+        boxes = self.chunk_boxes[ride_id]
+        seen = -1
+        for chunk in sorted(chunks):
+            start = max(boxes[chunk][4], seen + 1)
+            end = boxes[chunk][5]
+            for i in range(start, end):
+                yield i
+            seen = max(seen, end - 1)
+
+    def _points_near(self, lat, lon, radius_m):
+        """Get {ride_id: [point index, ...]} for points within radius_m"""
+        hits = {}
+        for ride_id, chunks in self._candidate_chunks(*radius_bbox(lat, lon, radius_m)).items():
+            points = self.ride_points(ride_id)
+            near = [i for i in self._chunk_indices(ride_id, chunks)
+                    if haversine(lat, lon, points[i][0], points[i][1]) <= radius_m]
+            if near:
+                hits[ride_id] = near
+        return hits
+
+    def query_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """Get names of rides with a point inside a bounding box"""
+        rides = []
+        for ride_id, chunks in self._candidate_chunks(min_lat, min_lon, max_lat, max_lon).items():
+            points = self.ride_points(ride_id)
+            for i in self._chunk_indices(ride_id, chunks):
+                lat, lon = points[i]
+                if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                    rides.append(self.names[ride_id])
+                    break
+        return sorted(rides)
+
+    def query_radius(self, lat, lon, radius_m):
+        """Get names of rides with a point within radius_m meters"""
+        return sorted(self.names[ride_id] for ride_id in self._points_near(lat, lon, radius_m))
+
+    def query_segment(self, start, end, tolerance_m=25.0, max_detour=1.5):
+        """
+        Find efforts on a road segment. An effort passes within tolerance_m
+        of start, later within tolerance_m of end, and the distance ridden
+        in between is at most max_detour times the straight start-end
+        distance (plus 2 * tolerance_m). The detour limit allows for a
+        curving road but drops rides that leave and come back much later.
+        start, end: (lat, lon)
+        Returns [{'ride', 'start_index', 'end_index'}, ...]
+        """
+        start_hits = self._points_near(start[0], start[1], tolerance_m)
+        end_hits = self._points_near(end[0], end[1], tolerance_m)
+        max_length = max_detour * haversine(start[0], start[1], end[0], end[1]) + 2 * tolerance_m
+
+        efforts = []
+        for ride_id in start_hits.keys() & end_hits.keys():
+            distances = self.ride_distances(ride_id)
+            valid = lambda first, last: distances[last] - distances[first] <= max_length
+            for first, last in match_efforts(start_hits[ride_id], end_hits[ride_id], valid):
+                efforts.append({'ride': self.names[ride_id], 'start_index': first, 'end_index': last})
+        efforts.sort(key=lambda e: (e['ride'], e['start_index']))
+        return efforts
+
+
+def linear_bbox(index, min_lat, min_lon, max_lat, max_lon):
+    """Reference bbox query scanning every point"""
+    return sorted(index.names[ride_id] for ride_id in range(len(index))
+                  if any(min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
+                         for lat, lon in index.ride_points(ride_id)))
+
+
+def linear_radius(index, lat, lon, radius_m):
+    """Reference radius query scanning every point"""
+    return sorted(index.names[ride_id] for ride_id in range(len(index))
+                  if any(haversine(lat, lon, p[0], p[1]) <= radius_m for p in index.ride_points(ride_id)))
+
+
+def linear_segment(index, start, end, tolerance_m=25.0, max_detour=1.5):
+    """Reference segment query scanning every point"""
+    max_length = max_detour * haversine(start[0], start[1], end[0], end[1]) + 2 * tolerance_m
+    efforts = []
+    for ride_id in range(len(index)):
+        points = index.ride_points(ride_id)
+        start_hits = [i for i, p in enumerate(points) if haversine(start[0], start[1], p[0], p[1]) <= tolerance_m]
+        if not start_hits:
+            continue
+        end_hits = [i for i, p in enumerate(points) if haversine(end[0], end[1], p[0], p[1]) <= tolerance_m]
+        distances = cumulative_distances(points)
+        valid = lambda first, last: distances[last] - distances[first] <= max_length
+        for first, last in match_efforts(start_hits, end_hits, valid):
+            efforts.append({'ride': index.names[ride_id], 'start_index': first, 'end_index': last})
+    efforts.sort(key=lambda e: (e['ride'], e['start_index']))
+    return efforts
+
+
+def synthetic_rides(count, points_per_ride=30, step_m=100.0, seed=1):
+    """Random-walk rides spread over ~50 x 50 km, for benchmarking"""
+    rng = random.Random(seed)
+    for n in range(count):
+        lat = 37.5 + rng.uniform(0, 0.45)
+        lon = -122.5 + rng.uniform(0, 0.55)
+        heading = rng.uniform(0, 2 * math.pi)
+        points = []
+        for _ in range(points_per_ride):
+            heading += rng.gauss(0, 0.3)
+            lat += step_m * math.cos(heading) / METERS_PER_DEG
+            lon += step_m * math.sin(heading) / (METERS_PER_DEG * math.cos(math.radians(lat)))
+            points.append((lat, lon))
+        yield f"ride{n:06d}", points
+
+
+def _time_query(func, *args, repeats=3):
+    """Run a query a few times, return (result, average ms)"""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = func(*args)
+    return result, (time.perf_counter() - start) / repeats * 1000
+
+
+def benchmark(ride_counts=(10000, 100000)):
+    """
+    Compare indexed query latency with a linear scan.
+    The index is written to disk and reloaded first, as the CLI does, so
+    the load time is reported too: every CLI query pays it once.
+    """
+    print("=" * 72)
+    print("Ride index vs linear scan")
+    print("=" * 72)
+    print(f"{'Rides':>8}  {'Query':<10}{'Results':>9}{'Cold ms':>10}{'Index ms':>10}{'Linear ms':>11}{'Speedup':>9}")
+
+    for count in ride_counts:
+        work_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(work_dir, 'index.jsonl')
+            index = RideIndex(path)
+            start = time.perf_counter()
+            for name, points in synthetic_rides(count):
+                index.add_ride(name, points)
+            build_time = time.perf_counter() - start
+            # Segment taken from an existing ride so it has at least one effort
+            sample = index.ride_points(len(index) // 2)
+            index.close()
+
+            start = time.perf_counter()
+            index = RideIndex(path)
+            load_time = time.perf_counter() - start
+
+            queries = [
+                ('bbox', index.query_bbox, linear_bbox, (37.70, -122.30, 37.71, -122.29)),
+                ('radius', index.query_radius, linear_radius, (37.75, -122.25, 500.0)),
+                ('segment', index.query_segment, linear_segment, (sample[5], sample[15], 25.0)),
+            ]
+            # Index first, while only the rides it touches have been read from disk
+            timings = []
+            for name, indexed, linear, args in queries:
+                _, cold_ms = _time_query(indexed, *args, repeats=1)
+                fast, fast_ms = _time_query(indexed, *args)
+                timings.append((fast, cold_ms, fast_ms))
+
+            # Linear scans get every ride's points in memory, to compare query work only
+            for ride_id in range(len(index)):
+                index.ride_points(ride_id)
+            for (name, indexed, linear, args), (fast, cold_ms, fast_ms) in zip(queries, timings):
+                slow, slow_ms = _time_query(lambda *a: linear(index, *a), *args, repeats=1)
+                assert fast == slow, f"{name} results differ from linear scan"
+                print(f"{count:>8}  {name:<10}{len(fast):>9}{cold_ms:10.2f}{fast_ms:10.2f}"
+                      f"{slow_ms:11.1f}{slow_ms / max(fast_ms, 1e-9):8.0f}x")
+            print(f"{count:>8}  build {build_time:.2f}s, load {load_time:.2f}s "
+                  f"(paid once per CLI query), {len(index.grid)} cells")
+            index.close()
+        finally:
+            shutil.rmtree(work_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spatial index over archived rides")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ingest = commands.add_parser('ingest', help="Add new rides from an archive to the index")
+    ingest.add_argument('index')
+    ingest.add_argument('archive')
+
+    bbox = commands.add_parser('bbox', help="Rides passing through a bounding box")
+    bbox.add_argument('index')
+    for field in ('min_lat', 'min_lon', 'max_lat', 'max_lon'):
+        bbox.add_argument(field, type=float)
+
+    radius = commands.add_parser('radius', help="Rides passing within a radius of a point")
+    radius.add_argument('index')
+    radius.add_argument('lat', type=float)
+    radius.add_argument('lon', type=float)
+    radius.add_argument('radius_m', type=float)
+
+    segment = commands.add_parser('segment', help="Efforts on a segment from (lat1, lon1) to (lat2, lon2)")
+    segment.add_argument('index')
+    for field in ('lat1', 'lon1', 'lat2', 'lon2'):
+        segment.add_argument(field, type=float)
+    segment.add_argument('--tolerance', type=float, default=25.0, help="Match distance in meters")
+    segment.add_argument('--max-detour', type=float, default=1.5,
+                         help="Max distance ridden between start and end, as a multiple of the straight distance")
+
+    bench = commands.add_parser('bench', help="Compare query latency with a linear scan")
+    bench.add_argument('--rides', default="10000,100000", help="Comma separated ride counts")
+
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        benchmark([int(n) for n in args.rides.split(',')])
+        return
+
+    index = RideIndex(args.index)
+    if args.command == 'ingest':
+        added = index.ingest(args.archive)
+        index.close()
+        print(f"Added {added} rides ({len(index)} indexed) -> {args.index}")
+    elif args.command == 'bbox':
+        print(json.dumps(index.query_bbox(args.min_lat, args.min_lon, args.max_lat, args.max_lon)))
+    elif args.command == 'radius':
+        print(json.dumps(index.query_radius(args.lat, args.lon, args.radius_m)))
+    else:
+        print(json.dumps(index.query_segment((args.lat1, args.lon1), (args.lat2, args.lon2),
+                                             args.tolerance, args.max_detour)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,464 @@
+"""
+Level-of-detail route tiles for the dashboard map (runs on a PC, not on the Pico-W)
+
+For every ride exported by RideTracker this builds a pyramid of simplified
+polylines (one per zoom level) and cuts them into the same z/x/y tiles that
+Leaflet uses, so the web client only downloads what is visible at the
+current zoom instead of every raw point from GET /gps.
+
+Layout on disk:
+  <tiles_dir>/index.json       - zoom range and per-ride bounding boxes
+  <tiles_dir>/<z>/<x>/<y>.json - {ride_id: [[[lat, lon], ...], ...]}
+
+Usage:
+  python route_tiles.py build <archive_dir> <tiles_dir> [--min-zoom 8] [--max-zoom 17]
+  python route_tiles.py query <tiles_dir> <min_lat> <min_lon> <max_lat> <max_lon> <zoom>
+  python route_tiles.py bench [--points 50000]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from reprocess import iter_ride_files, iter_ride_points
+
+TILE_SIZE = 256          # Pixels per tile edge, same as OpenStreetMap/Leaflet
+TOLERANCE_PX = 0.5       # Max simplification error, in screen pixels
+MIN_ZOOM = 8
+MAX_ZOOM = 17
+MAX_LATITUDE = 85.05112878  # Web Mercator limit
+MAX_QUERY_TILES = 1024   # Per query; a full-screen map needs a few dozen
+MAX_CACHED_TILES = 4096
+MAX_JUMP_DEG = 0.05      # Larger steps between points (~5 km) break the line, as in ride_index.py
+
+
+def project(lat, lon):
+    """Project lat/lon to Web Mercator world coordinates in [0, 1)"""
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    x = (lon + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x, y
+
+
+def tile_for(lat, lon, zoom):
+    """Get the (x, y) tile containing a lat/lon at a zoom level"""
+    x, y = project(lat, lon)
+    n = 1 << zoom
+    return min(int(x * n), n - 1), min(int(y * n), n - 1)
+
+
+def is_valid_fix(lat, lon):
+    """Check a point is a usable GPS fix (not missing, out of range or a (0, 0) "null island" glitch)"""
+    if lat is None or lon is None:
+        return False
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        return False
+    return not (lat == 0.0 and lon == 0.0)
+
+
+def split_at_jumps(points):
+    """Split a ride into parts wherever consecutive points are more than MAX_JUMP_DEG apart"""
+    parts = [[points[0]]]
+    for prev, point in zip(points, points[1:]):
+        if abs(point[0] - prev[0]) > MAX_JUMP_DEG or abs(point[1] - prev[1]) > MAX_JUMP_DEG:
+            parts.append([point])
+        else:
+            parts[-1].append(point)
+    return parts
+
+
+def simplify(points, tolerance):
+    """
+    Douglas-Peucker simplification.
+    points: list of (lat, lon, world_x, world_y); tolerance in world units.
+    Iterative so long rides do not hit the recursion limit.
+    """
+    if len(points) < 3:
+        return list(points)
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    tolerance_sq = tolerance * tolerance
+
+    while stack:
+        first, last = stack.pop()
+        ax, ay = points[first][2], points[first][3]
+        bx, by = points[last][2], points[last][3]
+        dx = bx - ax
+        dy = by - ay
+        length_sq = dx * dx + dy * dy
+
+        max_dist_sq = 0.0
+        index = first
+        for i in range(first + 1, last):
+            px, py = points[i][2], points[i][3]
+            if length_sq == 0:
+                dist_sq = (px - ax) ** 2 + (py - ay) ** 2
+            else:
+                t = ((px - ax) * dx + (py - ay) * dy) / length_sq
+                t = max(0.0, min(1.0, t))
+                dist_sq = (px - ax - t * dx) ** 2 + (py - ay - t * dy) ** 2
+            if dist_sq > max_dist_sq:
+                max_dist_sq = dist_sq
+                index = i
+
+        if max_dist_sq > tolerance_sq:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return [p for p, k in zip(points, keep) if k]
+
+
+def segment_tiles(x0, y0, x1, y1):
+    """Yield every tile a segment passes through (coordinates in tile units)"""
+    tx, ty = int(math.floor(x0)), int(math.floor(y0))
+    end_x, end_y = int(math.floor(x1)), int(math.floor(y1))
+    dx = x1 - x0
+    dy = y1 - y0
+    step_x = 1 if dx > 0 else -1
+    step_y = 1 if dy > 0 else -1
+    t_max_x = ((tx + (step_x > 0)) - x0) / dx if dx else math.inf
+    t_max_y = ((ty + (step_y > 0)) - y0) / dy if dy else math.inf
+    t_delta_x = abs(1 / dx) if dx else math.inf
+    t_delta_y = abs(1 / dy) if dy else math.inf
+
+    yield tx, ty
+    for _ in range(abs(end_x - tx) + abs(end_y - ty)):
+        if t_max_x < t_max_y:
+            tx += step_x
+            t_max_x += t_delta_x
+        else:
+            ty += step_y
+            t_max_y += t_delta_y
+        yield tx, ty
+
+
+def cut_into_tiles(points, zoom):
+    """
+    Split a simplified polyline into per-tile runs.
+    Segments crossing a tile edge are kept whole in both tiles so the
+    line stays continuous when tiles are drawn side by side.
+    Returns {(x, y): [[[lat, lon], ...], ...]}
+    """
+    n = 1 << zoom
+    tiles = {}
+
+    if len(points) == 1:
+        lat, lon, wx, wy = points[0]
+        key = (min(int(wx * n), n - 1), min(int(wy * n), n - 1))
+        tiles[key] = [[[lat, lon]]]
+        return tiles
+
+    # Each segment starts with the previous segment's end point object,
+    # so a run can be extended by checking identity with its last point
+    b_ll = [points[0][0], points[0][1]]
+    for a, b in zip(points, points[1:]):
+        a_ll = b_ll
+        b_ll = [b[0], b[1]]
+        for tx, ty in segment_tiles(a[2] * n, a[3] * n, b[2] * n, b[3] * n):
+            if not (0 <= tx < n and 0 <= ty < n):
+                continue
+            runs = tiles.setdefault((tx, ty), [])
+            # Extend the current run if this segment continues it
+            if runs and runs[-1][-1] is a_ll:
+                runs[-1].append(b_ll)
+            else:
+                runs.append([a_ll, b_ll])
+    return tiles
+
+
+def build_pyramid(points, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    """
+    Build {zoom: {(x, y): runs}} for one ride.
+    Each zoom is simplified from the next finer one, which is much cheaper
+    than simplifying the raw track every time. The line is broken at large
+    jumps so a glitch does not draw a segment across the map.
+    """
+    pyramid = {zoom: {} for zoom in range(min_zoom, max_zoom + 1)}
+    for part in split_at_jumps(points):
+        projected = [(round(p[0], 6), round(p[1], 6)) + project(p[0], p[1]) for p in part]
+        for zoom in range(max_zoom, min_zoom - 1, -1):
+            tolerance = TOLERANCE_PX / (TILE_SIZE * (1 << zoom))
+            projected = simplify(projected, tolerance)
+            for key, runs in cut_into_tiles(projected, zoom).items():
+                pyramid[zoom].setdefault(key, []).extend(runs)
+    return pyramid
+
+
+def _tile_path(tiles_dir, zoom, x, y):
+    return os.path.join(tiles_dir, str(zoom), str(x), f"{y}.json")
+
+
+def _merge_fragments(work_dir):
+    """Merge each tile's per-ride fragment lines into its final JSON file, one tile at a time"""
+    for root, _, files in os.walk(work_dir):
+        for name in files:
+            if not name.endswith('.part'):
+                continue
+            part = os.path.join(root, name)
+            content = {}
+            with open(part) as f:
+                for line in f:
+                    ride_id, runs = json.loads(line)
+                    content[ride_id] = runs
+            with open(part[:-len('.part')], 'w') as f:
+                json.dump(content, f, separators=(',', ':'))
+            os.remove(part)
+
+
+def build_tiles(archive_dir, tiles_dir, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    """
+    Build tiles for every ride in the archive. Returns the number of rides.
+    Rides that cannot be read are reported and left out.
+    Each ride's tiles are appended as fragments to disk straight away, so
+    memory holds one ride at a time rather than the whole archive. The
+    result is built in a temporary directory and swapped in at the end,
+    so tiles from removed or changed rides never linger.
+    """
+    tiles_dir = os.path.abspath(tiles_dir)
+    if os.path.isdir(tiles_dir) and os.listdir(tiles_dir) \
+            and not os.path.exists(os.path.join(tiles_dir, 'index.json')):
+        raise ValueError(f"{tiles_dir} is not empty and is not a tile directory")
+
+    parent = os.path.dirname(tiles_dir)
+    os.makedirs(parent, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='.tiles-', dir=parent)
+    rides = {}
+    made_dirs = set()
+
+    try:
+        for path in iter_ride_files(archive_dir):
+            ride_id = os.path.splitext(os.path.relpath(path, archive_dir))[0].replace(os.sep, '/')
+            try:
+                points = [(p['lat'], p['lon']) for p in iter_ride_points(path)
+                          if is_valid_fix(p['lat'], p['lon'])]
+            except Exception as e:
+                # e.g. a truncated GPX from an interrupted export
+                print(f"Skipping {ride_id}: {type(e).__name__}: {e}")
+                continue
+            if not points:
+                continue
+
+            rides[ride_id] = {
+                'points': len(points),
+                'bbox': [min(p[0] for p in points), min(p[1] for p in points),
+                         max(p[0] for p in points), max(p[1] for p in points)],
+            }
+            for zoom, ride_tiles in build_pyramid(points, min_zoom, max_zoom).items():
+                for (x, y), runs in ride_tiles.items():
+                    part = _tile_path(work_dir, zoom, x, y) + '.part'
+                    folder = os.path.dirname(part)
+                    if folder not in made_dirs:
+                        os.makedirs(folder, exist_ok=True)
+                        made_dirs.add(folder)
+                    with open(part, 'a') as f:
+                        f.write(json.dumps([ride_id, runs], separators=(',', ':')) + '\n')
+
+        _merge_fragments(work_dir)
+        with open(os.path.join(work_dir, 'index.json'), 'w') as f:
+            json.dump({'min_zoom': min_zoom, 'max_zoom': max_zoom, 'rides': rides}, f)
+
+        if os.path.exists(tiles_dir):
+            old_dir = work_dir + '.old'
+            os.rename(tiles_dir, old_dir)
+            os.rename(work_dir, tiles_dir)
+            shutil.rmtree(old_dir)
+        else:
+            os.rename(work_dir, tiles_dir)
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+    return len(rides)
+
+
+class TileStore:
+    """
+    Read-only access to a built tile directory.
+    Queries only visit tiles that exist on disk (from a per-zoom listing
+    read once), so their cost does not grow with the size of the box.
+    """
+
+    def __init__(self, tiles_dir):
+        self.tiles_dir = tiles_dir
+        with open(os.path.join(tiles_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.min_zoom = index['min_zoom']
+        self.max_zoom = index['max_zoom']
+        self.rides = index['rides']
+        self.listing = {}   # zoom -> {x: sorted [y, ...]} of tiles on disk
+        self.cache = OrderedDict()
+
+    def _tiles_at(self, zoom):
+        """Get {x: sorted [y, ...]} for the tiles built at a zoom level"""
+        if zoom not in self.listing:
+            tiles = {}
+            zoom_dir = os.path.join(self.tiles_dir, str(zoom))
+            if os.path.isdir(zoom_dir):
+                for x_entry in os.scandir(zoom_dir):
+                    if not x_entry.is_dir():
+                        continue
+                    ys = sorted(int(name[:-len('.json')]) for name in os.listdir(x_entry.path)
+                                if name.endswith('.json'))
+                    if ys:
+                        tiles[int(x_entry.name)] = ys
+            self.listing[zoom] = tiles
+        return self.listing[zoom]
+
+    def get_tile(self, zoom, x, y):
+        """Get one tile's content ({} if no ride passes through it)"""
+        if y not in self._tiles_at(zoom).get(x, ()):
+            return {}
+
+        key = (zoom, x, y)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        with open(_tile_path(self.tiles_dir, zoom, x, y)) as f:
+            content = json.load(f)
+        self.cache[key] = content
+        if len(self.cache) > MAX_CACHED_TILES:
+            self.cache.popitem(last=False)
+        return content
+
+    def query(self, min_lat, min_lon, max_lat, max_lon, zoom):
+        """
+        Get the non-empty tiles covering a bounding box.
+        The zoom is clamped to the built range; past max_zoom the finest
+        tiles are already exact, so they are returned as-is.
+        Raises ValueError if more than MAX_QUERY_TILES tiles would be
+        returned (zoom out instead).
+        Returns [{'z', 'x', 'y', 'rides'}, ...]
+        """
+        zoom = max(self.min_zoom, min(self.max_zoom, int(zoom)))
+        # Tile y grows southwards, so max_lat gives the smallest y
+        x0, y0 = tile_for(max_lat, min_lon, zoom)
+        x1, y1 = tile_for(min_lat, max_lon, zoom)
+
+        keys = []
+        for x, ys in self._tiles_at(zoom).items():
+            if x0 <= x <= x1:
+                keys.extend((x, y) for y in ys[bisect_left(ys, y0):bisect_right(ys, y1)])
+                if len(keys) > MAX_QUERY_TILES:
+                    raise ValueError(f"more than {MAX_QUERY_TILES} tiles at zoom {zoom}, use a lower zoom")
+
+        return [{'z': zoom, 'x': x, 'y': y, 'rides': self.get_tile(zoom, x, y)}
+                for x, y in sorted(keys)]
+
+
+def synthetic_ride(n_points, lat=37.7749, lon=-122.4194, step_m=5.0, seed=1):
+    """Random-walk ride with GPS-like point spacing, for benchmarking"""
+    rng = random.Random(seed)
+    heading = rng.uniform(0, 2 * math.pi)
+    points = []
+    for _ in range(n_points):
+        heading += rng.gauss(0, 0.15)
+        lat += step_m * math.cos(heading) / 111320.0
+        lon += step_m * math.sin(heading) / (111320.0 * math.cos(math.radians(lat)))
+        points.append({'lat': lat, 'lon': lon, 'alt': 10.0, 'speed': 18.0})
+    return points
+
+
+def benchmark(n_points=50000):
+    """Compare payload size and response time: raw points vs tiles in view"""
+    archive = tempfile.mkdtemp()
+    tiles_dir = os.path.join(archive, 'tiles')
+    try:
+        raw = synthetic_ride(n_points)
+        with open(os.path.join(archive, 'ride.jsonl'), 'w') as f:
+            for p in raw:
+                f.write(json.dumps(p) + '\n')
+
+        start = time.perf_counter()
+        build_tiles(archive, tiles_dir)
+        build_time = time.perf_counter() - start
+
+        print("=" * 72)
+        print(f"Route tiles vs raw points ({n_points} points, build {build_time:.2f}s)")
+        print("=" * 72)
+        print(f"{'View':<22}{'Raw KB':>9}{'Raw ms':>9}{'Tile KB':>10}{'Tile ms':>10}{'Tiles':>7}{'Size':>7}")
+
+        lats = [p['lat'] for p in raw]
+        lons = [p['lon'] for p in raw]
+        whole = (min(lats), min(lons), max(lats), max(lons))
+        mid = raw[len(raw) // 2]
+        views = [('whole ride z10', whole, 10), ('whole ride z13', whole, 13)]
+        for zoom, span in ((15, 0.01), (17, 0.002)):
+            views.append((f"street z{zoom}", (mid['lat'] - span, mid['lon'] - span,
+                                              mid['lat'] + span, mid['lon'] + span), zoom))
+
+        repeats = 5
+        for name, bbox, zoom in views:
+            # Raw: what GET /gps ships today - every point, serialized
+            start = time.perf_counter()
+            for _ in range(repeats):
+                raw_payload = json.dumps({'success': True, 'count': len(raw), 'data': raw})
+            raw_ms = (time.perf_counter() - start) / repeats * 1000
+
+            # Tiles: fresh store each time so disk reads are included
+            start = time.perf_counter()
+            for _ in range(repeats):
+                tiles = TileStore(tiles_dir).query(*bbox, zoom)
+                tile_payload = json.dumps(tiles, separators=(',', ':'))
+            tile_ms = (time.perf_counter() - start) / repeats * 1000
+
+            ratio = len(tile_payload) / len(raw_payload) * 100
+            print(f"{name:<22}{len(raw_payload) / 1024:9.1f}{raw_ms:9.2f}"
+                  f"{len(tile_payload) / 1024:10.1f}{tile_ms:10.2f}{len(tiles):7}{ratio:6.1f}%")
+    finally:
+        shutil.rmtree(archive)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute level-of-detail route tiles")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help="Build tiles from an archive of exported rides")
+    build.add_argument('archive')
+    build.add_argument('tiles_dir')
+    build.add_argument('--min-zoom', type=int, default=MIN_ZOOM)
+    build.add_argument('--max-zoom', type=int, default=MAX_ZOOM)
+
+    query = commands.add_parser('query', help="Print tiles in a bounding box as JSON")
+    query.add_argument('tiles_dir')
+    query.add_argument('min_lat', type=float)
+    query.add_argument('min_lon', type=float)
+    query.add_argument('max_lat', type=float)
+    query.add_argument('max_lon', type=float)
+    query.add_argument('zoom', type=int)
+
+    bench = commands.add_parser('bench', help="Compare tiles against shipping raw points")
+    bench.add_argument('--points', type=int, default=50000)
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        try:
+            rides = build_tiles(args.archive, args.tiles_dir, args.min_zoom, args.max_zoom)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"Built tiles for {rides} rides in {time.perf_counter() - start:.2f}s -> {args.tiles_dir}")
+    elif args.command == 'query':
+        store = TileStore(args.tiles_dir)
+        try:
+            tiles = store.query(args.min_lat, args.min_lon, args.max_lat, args.max_lon, args.zoom)
+        except ValueError as e:
+            parser.error(str(e))
+        print(json.dumps(tiles))
+    else:
+        benchmark(args.points)
+
+
+if __name__ == "__main__":
+    main()